@@ -1,9 +1,18 @@
-from datetime import datetime, timedelta
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from decimal import Decimal, ROUND_HALF_UP, getcontext
-from typing import Dict, Literal
+from enum import StrEnum
+from fractions import Fraction
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Tuple
+import logging
 import os
+import time
 import httpx
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse
 
 # -----------------------------------------------------------------------------
 # Configuration
@@ -12,20 +21,106 @@ from fastapi import FastAPI, HTTPException, Query
 # The cache will be refreshed every 5 minutes.
 CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))  # seconds (default: 5 min)
 
+# After a failed refresh, Binance is left alone for this long. Clients that keep
+# calling after a 429 get IP-banned.
+REFRESH_RETRY_DELAY = int(os.getenv("REFRESH_RETRY_DELAY", "10"))  # seconds
+
+# Expired rates are served while refreshing, but never for longer than this past
+# expiry; after that requests fail until a refresh succeeds.
+MAX_STALENESS = int(os.getenv("MAX_STALENESS", "3600"))  # seconds (default: 1 h)
+
 # This is the site we'll get the data from:
 BINANCE = "https://api.binance.com/api/v3/ticker/price"
 
+# /convert multiplies with integers by default. Set DECIMAL_ARITHMETIC=1 to fall
+# back to Decimal arithmetic unless a request overrides it with high_precision.
+DECIMAL_ARITHMETIC = os.getenv("DECIMAL_ARITHMETIC", "0") == "1"
+
+# On the integer fast path quantities are taken in micro-units (6 decimal places).
+QUANTITY_SCALE = 10 ** 6
+
+# Largest accepted quantity. Converted at rates up to 10, the result still fits the
+# 28-digit Decimal context at cent precision, and it is far from float overflow.
+MAX_QUANTITY = 10 ** 24
+
+
+# Supported currencies. Members compare and hash like their string values, so
+# (Ccy, Ccy) tuples index the rate table directly.
+class Ccy(StrEnum):
+    USD = "USD"
+    EUR = "EUR"
+    GBP = "GBP"
+
+
+# Binance symbol quoting 1 BTC in each currency (USD is quoted in USDT).
+_BTC_SYMBOL = {Ccy.USD: "BTCUSDT", Ccy.EUR: "BTCEUR", Ccy.GBP: "BTCGBP"}
+
 # -----------------------------------------------------------------------------
 # FastAPI app
 # -----------------------------------------------------------------------------
-app = FastAPI(title="Currency Converter", version="1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Own one pooled HTTP client for the whole app lifetime."""
+    # Reusing the client keeps the DNS/TCP/TLS setup to Binance warm between
+    # cache refreshes instead of paying for it on every miss.
+    app.state.http = httpx.AsyncClient(
+        timeout=10.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=4),
+    )
+    yield
+    # Stop a background refresh before closing the client it is using.
+    task = _refresh_task
+    if task is not None and not task.done():
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await app.state.http.aclose()
+
+
+app = FastAPI(
+    title="Currency Converter",
+    version="1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,              # C JSON encoder for every endpoint
+)
+
+logger = logging.getLogger(__name__)
+
+# Use Decimal for financial precision. The pure-Python fallback is far slower
+# than the C implementation, so make it visible if we ended up with it.
+try:
+    import _decimal  # noqa: F401
+except ImportError:
+    logger.warning("C _decimal module not available; using the slow pure-Python decimal")
 
-# Use Decimal for financial precision
 getcontext().prec = 28
 
-# Simple in-memory cache
-_cache: Dict[str, Decimal] = {}
-_cache_expiry: datetime | None = None
+
+class _RateSnapshot(NamedTuple):
+    """Read-only result of one cache refresh."""
+    raw: Mapping[str, Decimal]                            # Binance prices: {'BTCUSDT': ..., ...}
+    xrs: Mapping[str, Decimal]                            # cross rates: {'EURUSD': ..., ...}
+    rates_body: bytes                                     # /rates JSON body, serialised once
+    rate_table: Mapping[Tuple[Ccy, Ccy], Decimal]         # (ccy_from, ccy_to) -> rate, identity included
+    rate_table_exact: Mapping[Tuple[Ccy, Ccy], Tuple[int, int]]   # same, as exact (num, den) for _convert_exact
+    expires_at: float                                     # time.monotonic() deadline
+
+
+# Simple in-memory cache. Each refresh publishes a new read-only snapshot by
+# rebinding `_cache`, so readers never see a half-built or mutated dict.
+_cache: _RateSnapshot | None = None
+
+# The refresh currently in flight, if any. Requests that find the cache expired
+# share it, so a burst after expiry triggers one fetch. Holding the reference
+# also keeps the background task alive.
+_refresh_task: "asyncio.Task[_RateSnapshot] | None" = None
+
+# No new refresh is started before this time.monotonic() value.
+_retry_at: float = 0.0
+
+# Response header set when a request was served from an expired snapshot.
+STALE_HEADER = "X-Rates-Stale"
 
 # -----------------------------------------------------------------------------
 # Fetch prices from Binance
@@ -34,45 +129,100 @@ async def _fetch_rates() -> Dict[str, Decimal]:
     """Fetch BTC/fiat prices from Binance."""
     symbols = ["BTCUSDT", "BTCEUR", "BTCGBP"]
 
-    rates: Dict[str, Decimal] = {}
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        for sym in symbols:
-            r = await client.get(BINANCE, params={"symbol": sym})
-            if r.status_code != 200:
-                raise HTTPException(status_code=502, detail=f"Binance error for {sym}")
-            price = r.json().get("price")
-            if price is None:
-                raise HTTPException(status_code=502, detail=f"Malformed Binance response for {sym}")
-            rates[sym] = Decimal(price)
+    # One batch call for all symbols: /ticker/price accepts a compact JSON array
+    # in `symbols` and returns [{"symbol": ..., "price": ...}, ...].
+    params = {"symbols": orjson.dumps(symbols).decode()}
+    r = await app.state.http.get(BINANCE, params=params)
+    if r.status_code != 200:
+        raise HTTPException(status_code=502, detail="Binance error")
+
+    try:
+        rates = {item["symbol"]: Decimal(item["price"]) for item in orjson.loads(r.content)}
+    except (ValueError, TypeError, KeyError, ArithmeticError):
+        raise HTTPException(status_code=502, detail="Malformed Binance response")
+    if set(rates) != set(symbols):
+        raise HTTPException(status_code=502, detail="Malformed Binance response")
     return rates
 
 
-async def _get_rates_cached() -> Dict[str, Decimal]:
+async def _refresh() -> _RateSnapshot:
+    """Fetch fresh prices and publish a new snapshot."""
+    global _cache, _retry_at
+    # We can calculate all the rates in one go because there are only three currencies
+    # in the system. If there were more currencies, it would be better to implement
+    # another system using lazy initialisation.
+    try:
+        prices = await _fetch_rates()                   # {'BTCUSDT': ..., 'BTCEUR': ..., 'BTCGBP': ...}
+        _cache = _build_snapshot(prices)
+    except Exception:
+        # Set before the task completes, so no request can slip in another attempt.
+        _retry_at = time.monotonic() + REFRESH_RETRY_DELAY
+        raise
+    return _cache
+
+
+def _log_refresh_failure(task: "asyncio.Task[_RateSnapshot]") -> None:
+    """Log a failed refresh; background refreshes have nobody else to report to."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Rate refresh failed: %r", task.exception())
+
+
+def _start_refresh() -> "asyncio.Task[_RateSnapshot] | None":
+    """Return the in-flight refresh, starting one if none is running and we are not backing off."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        if time.monotonic() < _retry_at:
+            return None
+        _refresh_task = asyncio.create_task(_refresh())
+        _refresh_task.add_done_callback(_log_refresh_failure)
+    return _refresh_task
+
+
+async def _get_rates_cached() -> _RateSnapshot:
     """
-    Return cached symbols + cross rates cache if valid;
-    otherwise refresh and rebuild once.
+    Return the cached snapshot. Once it expires, keep serving it (stale) for up to
+    MAX_STALENESS while a single background task refreshes it; only wait when
+    there is no usable cache.
     """
-    global _cache, _cache_expiry
-    if _cache and _cache_expiry and datetime.utcnow() < _cache_expiry:
+    cache = _cache
+    now = time.monotonic()
+    if cache is not None and now < cache.expires_at:
         # The cache has not expired yet. Let's use the current cache.
-        return _cache
+        return cache
 
-    # Let's refresh the cache with fresh values. We can calculate all the rates in one go
-    # because there are only three currencies in the system. If there were more currencies,
-    # it would be better to implement another system using lazy initialisation.
-    prices = await _fetch_rates()                       # {'BTCUSDT': ..., 'BTCEUR': ..., 'BTCGBP': ...}
-    cross_rates = _build_cross_rates(prices)        # {'EURUSD': ..., 'USDGBP': ..., 'EURGBP': ..., ...}
-    _cache = {**prices, **cross_rates}                  # flat dict with both layers
+    refresh = _start_refresh()
+    if cache is not None and now < cache.expires_at + MAX_STALENESS:
+        # Stale-while-revalidate: a Binance outage must not fail requests we can answer.
+        return cache
+
+    if refresh is None:
+        # A refresh just failed and we are backing off; nothing usable to serve.
+        raise HTTPException(status_code=503, detail="Exchange rates temporarily unavailable")
+
+    # Nothing to fall back on. Shield the shared refresh so a client disconnecting
+    # does not cancel it for everyone else waiting on it.
+    return await asyncio.shield(refresh)
 
-    _cache_expiry = datetime.utcnow() + timedelta(seconds=CACHE_TTL)
-    return _cache
+
+def _is_stale(snapshot: _RateSnapshot) -> bool:
+    """Tell whether `snapshot` has outlived CACHE_TTL."""
+    return time.monotonic() >= snapshot.expires_at
 
 
 # -----------------------------------------------------------------------------
 # Build USD/EUR/GBP cross rates
 # -----------------------------------------------------------------------------
-def _build_cross_rates(prices: Dict[str, Decimal]) -> Dict[str, Decimal]:
+def _build_cross_rates(prices: Mapping[str, Decimal]) -> Mapping[str, Decimal]:
     """Derive direct USD/EUR/GBP cross rates using BTC as bridge."""
+    # In calm markets Binance often returns the same last-traded prices on consecutive
+    # refreshes, so memoise on the prices themselves and skip the Decimal divisions.
+    return _cross_rates_for(tuple(sorted(prices.items())))
+
+
+@lru_cache(maxsize=4)
+def _cross_rates_for(price_items: Tuple[Tuple[str, Decimal], ...]) -> Mapping[str, Decimal]:
+    """Memoised body of _build_cross_rates, keyed by its sorted price items."""
+    prices = dict(price_items)
     if "BTCUSDT" not in prices:
         raise HTTPException(status_code=502, detail="BTCUSDT price missing")
 
@@ -90,16 +240,71 @@ def _build_cross_rates(prices: Dict[str, Decimal]) -> Dict[str, Decimal]:
 
     # Derive EUR/GBP cross directly. We can do this because there are only 3 currencies.
     # If there were more currencies, we would have to implement a function that computes all
-    # the possible pairs.
+    # the possible pairs. Both directions are stored so /convert never has to invert a rate.
     cross_rates["EURGBP"] = cross_rates["EURUSD"] * cross_rates["USDGBP"]
     cross_rates["GBPEUR"] = Decimal(1) / cross_rates["EURGBP"]
 
-    return cross_rates
+    # Read-only: the same mapping is handed to every caller with these prices.
+    return MappingProxyType(cross_rates)
+
+
+def _build_rate_table(cross_rates: Mapping[str, Decimal]) -> Dict[Tuple[Ccy, Ccy], Decimal]:
+    """Index every ordered currency pair, identity included, by (ccy_from, ccy_to)."""
+    # With 3 currencies this is 9 entries, so /convert needs a single lookup.
+    table: Dict[Tuple[Ccy, Ccy], Decimal] = {(c, c): Decimal(1) for c in Ccy}
+    for pair, rate in cross_rates.items():
+        table[(Ccy(pair[:3]), Ccy(pair[3:]))] = rate
+    return table
+
+
+def _build_exact_rate_table(prices: Mapping[str, Decimal]) -> Dict[Tuple[Ccy, Ccy], Tuple[int, int]]:
+    """Exact rate of every ordered pair as integers, ready for _convert_exact."""
+    # 1 FROM = (BTCTO / BTCFROM) TO. Working from the prices as fractions keeps the rate
+    # exact, so for quantities with at most 6 decimal places (exact in micro-units) the
+    # integer path rounds the true product. Finer quantities go through Decimal instead.
+    # The denominator is pre-multiplied so that cents = micros * num / den.
+    table: Dict[Tuple[Ccy, Ccy], Tuple[int, int]] = {}
+    for ccy_from, sym_from in _BTC_SYMBOL.items():
+        for ccy_to, sym_to in _BTC_SYMBOL.items():
+            rate = Fraction(prices[sym_to]) / Fraction(prices[sym_from])
+            table[(ccy_from, ccy_to)] = (rate.numerator, rate.denominator * (QUANTITY_SCALE // 100))
+    return table
+
+
+def _build_snapshot(prices: Dict[str, Decimal]) -> _RateSnapshot:
+    """Build the cached Decimal and exact-integer views from Binance prices."""
+    cross_rates = _build_cross_rates(prices)            # {'EURUSD': ..., 'USDGBP': ..., 'EURGBP': ..., ...}
+    rate_table = _build_rate_table(cross_rates)         # {('EUR', 'USD'): ..., ('USD', 'USD'): 1, ...}
+    return _RateSnapshot(
+        # The layers stay separate so BTC symbols and fiat pairs can never collide.
+        raw=MappingProxyType(dict(prices)),
+        xrs=cross_rates,                                # already read-only
+        rates_body=orjson.dumps({
+            "binance_prices": {k: float(v) for k, v in prices.items()},
+            "derived_cross_rates": {k: float(v) for k, v in cross_rates.items()},
+        }),
+        rate_table=MappingProxyType(rate_table),
+        rate_table_exact=MappingProxyType(_build_exact_rate_table(prices)),
+        expires_at=time.monotonic() + CACHE_TTL,
+    )
+
+
+_CENTS = Decimal("0.01")
 
 
 def round_number(x: Decimal) -> Decimal:
     """Round to 2 decimal places."""
-    return x.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    return x.quantize(_CENTS, ROUND_HALF_UP)
+
+
+def _convert_exact(micros: int, rate: Tuple[int, int]) -> float:
+    """Multiply a quantity in micro-units by an exact (num, den) rate, rounded half up to cents.
+
+    Exact only when `micros` is the quantity itself, i.e. it has at most 6 decimal places.
+    """
+    num, den = rate
+    cents = (2 * micros * num + den) // (2 * den)       # half up; quantity is always > 0
+    return cents / 100
 
 
 # -----------------------------------------------------------------------------
@@ -107,38 +312,35 @@ def round_number(x: Decimal) -> Decimal:
 # -----------------------------------------------------------------------------
 @app.get("/convert")
 async def convert(
-    ccy_from: Literal["USD", "EUR", "GBP"] = Query(..., description="Source currency"),
-    ccy_to:   Literal["USD", "EUR", "GBP"] = Query(..., description="Target currency"),
-    quantity: Decimal = Query(..., gt=Decimal("0"), description="Amount to convert"),
+    request: Request,
+    response: Response,
+    ccy_from: Ccy = Query(..., description="Source currency"),
+    ccy_to:   Ccy = Query(..., description="Target currency"),
+    quantity: float = Query(..., gt=0, le=MAX_QUANTITY, allow_inf_nan=False, description="Amount to convert"),
+    high_precision: bool = Query(DECIMAL_ARITHMETIC, description="Convert with Decimal arithmetic"),
 ):
     """Convert between USD, EUR, and GBP using cached, precomputed cross rates."""
-    try:
-        cache = await _get_rates_cached()         # flat dict
-
-        pair = f"{ccy_from}{ccy_to}"
-
-        if ccy_from == ccy_to:
-            # Special case where the two currencies are the same.
-            rate = Decimal(1)
-        elif pair in cache:
-            # direct cross rate already computed
-            rate = cache[pair]
-        else:
-            # Check if the reciprocal cross rate exists and use it.
-            reverse = f"{ccy_to}{ccy_from}"
-            if reverse in cache:
-                # use reciprocal if we only have reverse
-                rate = Decimal(1) / cache[reverse]
-            else:
-                raise HTTPException(status_code=400, detail=f"Unsupported pair {pair}")
-
-        converted = round_number(quantity * rate)
-        return {"quantity": float(converted), "ccy": ccy_to}
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {e}")
+    snapshot = await _get_rates_cached()
+    if _is_stale(snapshot):
+        response.headers[STALE_HEADER] = "true"
+    # Exact integer rates by default; the Decimal rates are kept as a fallback. The
+    # integer path works in micro-units, so a quantity with more than 6 decimal places
+    # would be rounded twice (to micros, then to cents): send it down the Decimal path.
+    if not high_precision:
+        micros = round(quantity * QUANTITY_SCALE)
+        high_precision = micros / QUANTITY_SCALE != quantity
+    table = snapshot.rate_table if high_precision else snapshot.rate_table_exact
+
+    # Every ordered pair, same-currency included, is precomputed at refresh time, and
+    # Ccy validation already rejected anything else, so the lookup cannot miss.
+    rate = table[(ccy_from, ccy_to)]
+
+    if high_precision:
+        # `quantity` has been through a float; use the exact digits the client sent.
+        converted = float(round_number(Decimal(request.query_params["quantity"]) * rate))
+    else:
+        converted = _convert_exact(micros, rate)
+    return {"quantity": converted, "ccy": ccy_to}
 
 
 @app.get("/rates")
@@ -146,7 +348,9 @@ async def rates():
     """
     For debugging purposes.
     """
-    cache = await _get_rates_cached()
-    raw = {k: float(v) for k, v in cache.items() if k.startswith("BTC")}
-    xrs = {k: float(v) for k, v in cache.items() if not k.startswith("BTC")}
-    return {"binance_prices": raw, "derived_cross_rates": xrs}
\ No newline at end of file
+    snapshot = await _get_rates_cached()
+    # The body only changes on refresh, so it is serialised once in _build_snapshot.
+    response = Response(content=snapshot.rates_body, media_type="application/json")
+    if _is_stale(snapshot):
+        response.headers[STALE_HEADER] = "true"
+    return response
\ No newline at end of file
@@ -1,6 +1,15 @@
+import asyncio
+import json
+import random
+import time
 import unittest
+from contextlib import contextmanager
 from decimal import Decimal
+from fractions import Fraction
 from unittest.mock import patch
+
+import httpx
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 
 import app
@@ -21,8 +30,30 @@ PRICES = {
     "BTCEUR":  Decimal("90000"),
     "BTCGBP":  Decimal("80000"),
 }
-CROSS_RATES = app._build_cross_rates(PRICES)
-FLAT_CACHE = {**PRICES, **CROSS_RATES}
+SNAPSHOT = app._build_snapshot(PRICES)
+
+# Non-round quotes, where rounding shortcuts show up as 1-cent differences.
+REALISTIC_SNAPSHOT = app._build_snapshot({
+    "BTCUSDT": Decimal("67234.12"),
+    "BTCEUR":  Decimal("61987.45"),
+    "BTCGBP":  Decimal("52876.33"),
+})
+
+# setUp patches the cache getter; keep the real one for the cache tests.
+REAL_GET_RATES_CACHED = app._get_rates_cached
+
+
+def _expired(snapshot, by=1.0):
+    """Return `snapshot` as if it had expired `by` seconds ago."""
+    return snapshot._replace(expires_at=time.monotonic() - by)
+
+
+@contextmanager
+def _cache_state(cache, fetch_rates):
+    """Run with the given cache and Binance fetcher, and no refresh history."""
+    with patch("app._cache", cache), patch("app._refresh_task", None), \
+            patch("app._retry_at", 0.0), patch("app._fetch_rates", new=fetch_rates):
+        yield
 
 
 class CurrencyConverterTests(unittest.TestCase):
@@ -31,9 +62,9 @@ class CurrencyConverterTests(unittest.TestCase):
         cls.client = TestClient(app.app)  # FastAPI app instance
 
     def setUp(self):
-        # Patch the async cache getter to return our flat cache
+        # Patch the async cache getter to return our snapshot
         async def _fake_get_rates_cached():
-            return FLAT_CACHE
+            return SNAPSHOT
         self.patcher = patch("app._get_rates_cached", new=_fake_get_rates_cached)
         self.patcher.start()
 
@@ -62,6 +93,186 @@ class CurrencyConverterTests(unittest.TestCase):
             places=12,
         )
 
+    def test_cross_rates_memoised_for_same_prices(self):
+        first = app._build_cross_rates(PRICES)
+        self.assertIs(app._build_cross_rates(dict(reversed(PRICES.items()))), first)
+        self.assertIsNot(app._build_cross_rates({**PRICES, "BTCEUR": Decimal("91000")}), first)
+        with self.assertRaises(TypeError):
+            first["EURUSD"] = Decimal(0)
+
+    def test_cross_rates_cover_both_directions(self):
+        cross_rates = app._build_cross_rates(PRICES)
+        self.assertEqual(
+            set(cross_rates),
+            {"USDEUR", "EURUSD", "USDGBP", "GBPUSD", "EURGBP", "GBPEUR"},
+        )
+
+    def test_snapshot_layers_are_separate(self):
+        self.assertEqual(dict(SNAPSHOT.raw), PRICES)
+        self.assertEqual(dict(SNAPSHOT.xrs), dict(app._build_cross_rates(PRICES)))
+
+    def test_rate_table_covers_all_ordered_pairs(self):
+        table = SNAPSHOT.rate_table
+        self.assertEqual(len(table), 9)
+        for ccy in app.Ccy:
+            self.assertEqual(table[(ccy, ccy)], Decimal(1))
+        self.assertEqual(table[("EUR", "GBP")], SNAPSHOT.xrs["EURGBP"])
+        num, den = SNAPSHOT.rate_table_exact[("USD", "EUR")]
+        self.assertEqual(Fraction(num, den) * (app.QUANTITY_SCALE // 100), Fraction(9, 10))
+
+    # ----- Cache tests -----
+
+    def test_concurrent_misses_fetch_once(self):
+        calls = 0
+
+        async def _fake_fetch_rates():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return PRICES
+
+        async def _run():
+            return await asyncio.gather(*(REAL_GET_RATES_CACHED() for _ in range(10)))
+
+        with _cache_state(None, _fake_fetch_rates):
+            results = asyncio.run(_run())
+        self.assertEqual(calls, 1)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_expired_cache_served_stale_while_refreshing(self):
+        stale = _expired(SNAPSHOT)
+        calls = 0
+
+        async def _fake_fetch_rates():
+            nonlocal calls
+            calls += 1
+            return PRICES
+
+        async def _run():
+            first = await REAL_GET_RATES_CACHED()
+            await app._refresh_task
+            second = await REAL_GET_RATES_CACHED()
+            return first, second
+
+        with _cache_state(stale, _fake_fetch_rates):
+            first, second = asyncio.run(_run())
+        self.assertIs(first, stale)
+        self.assertIsNot(second, stale)
+        self.assertFalse(app._is_stale(second))
+        self.assertEqual(calls, 1)
+
+    def test_failed_refresh_backs_off_and_keeps_serving_stale(self):
+        stale = _expired(SNAPSHOT)
+        calls = 0
+
+        async def _failing_fetch_rates():
+            nonlocal calls
+            calls += 1
+            raise HTTPException(status_code=502, detail="Binance error")
+
+        async def _run():
+            results = [await REAL_GET_RATES_CACHED()]
+            await asyncio.wait([app._refresh_task])
+            # Within the back-off window no new Binance call is made.
+            results.append(await REAL_GET_RATES_CACHED())
+            self.assertEqual(calls, 1)
+            # Once it has passed, the next request retries.
+            app._retry_at = 0.0
+            results.append(await REAL_GET_RATES_CACHED())
+            await asyncio.wait([app._refresh_task])
+            self.assertEqual(calls, 2)
+            return results
+
+        with _cache_state(stale, _failing_fetch_rates), self.assertLogs("app", level="WARNING"):
+            results = asyncio.run(_run())
+        self.assertTrue(all(r is stale for r in results))
+
+    def test_too_stale_cache_is_not_served(self):
+        too_stale = _expired(SNAPSHOT, by=app.MAX_STALENESS + 1)
+
+        async def _failing_fetch_rates():
+            raise HTTPException(status_code=502, detail="Binance error")
+
+        with _cache_state(too_stale, _failing_fetch_rates):
+            with self.assertRaises(HTTPException) as ctx:
+                asyncio.run(REAL_GET_RATES_CACHED())
+            self.assertEqual(ctx.exception.status_code, 502)
+            # Backing off: fail fast instead of calling Binance again.
+            with self.assertRaises(HTTPException) as ctx:
+                asyncio.run(REAL_GET_RATES_CACHED())
+            self.assertEqual(ctx.exception.status_code, 503)
+
+    def test_failed_refresh_without_cache_raises(self):
+        async def _failing_fetch_rates():
+            raise HTTPException(status_code=502, detail="Binance error")
+
+        with _cache_state(None, _failing_fetch_rates), self.assertRaises(HTTPException) as ctx:
+            asyncio.run(REAL_GET_RATES_CACHED())
+        self.assertEqual(ctx.exception.status_code, 502)
+
+    def test_shutdown_cancels_background_refresh(self):
+        client_closed_at_cancel = []
+
+        async def _hanging_fetch_rates():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                client_closed_at_cancel.append(app.app.state.http.is_closed)
+                raise
+
+        params = {"ccy_from": "USD", "ccy_to": "EUR", "quantity": "100"}
+        with _cache_state(_expired(SNAPSHOT), _hanging_fetch_rates), \
+                patch("app._get_rates_cached", new=REAL_GET_RATES_CACHED):
+            with TestClient(app.app) as client:
+                self.assertEqual(client.get("/convert", params=params).status_code, 200)
+                task = app._refresh_task
+                self.assertFalse(task.done())
+            self.assertTrue(task.cancelled())
+        # Cancelled by the lifespan while its HTTP client was still open.
+        self.assertEqual(client_closed_at_cancel, [False])
+
+    def test_stale_header(self):
+        async def _stale_get_rates_cached():
+            return _expired(SNAPSHOT)
+
+        params = {"ccy_from": "USD", "ccy_to": "EUR", "quantity": "100"}
+        self.assertNotIn(app.STALE_HEADER, self.client.get("/convert", params=params).headers)
+        with patch("app._get_rates_cached", new=_stale_get_rates_cached):
+            self.assertEqual(self.client.get("/convert", params=params).headers[app.STALE_HEADER], "true")
+            self.assertEqual(self.client.get("/rates").headers[app.STALE_HEADER], "true")
+
+    # ----- Binance fetch tests -----
+
+    def _fetch_with(self, handler):
+        """Run _fetch_rates against a mocked Binance transport."""
+        async def _run():
+            app.app.state.http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            try:
+                return await app._fetch_rates()
+            finally:
+                await app.app.state.http.aclose()
+        return asyncio.run(_run())
+
+    def test_fetch_rates_single_batch_call(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            symbols = json.loads(request.url.params["symbols"])
+            body = [{"symbol": s, "price": str(PRICES[s])} for s in symbols]
+            return httpx.Response(200, json=body)
+
+        self.assertEqual(self._fetch_with(handler), PRICES)
+        self.assertEqual(len(calls), 1)
+
+    def test_fetch_rates_missing_symbol(self):
+        def handler(request):
+            return httpx.Response(200, json=[{"symbol": "BTCUSDT", "price": "100000"}])
+
+        with self.assertRaises(HTTPException) as ctx:
+            self._fetch_with(handler)
+        self.assertEqual(ctx.exception.status_code, 502)
+
     # ----- API tests on /convert -----
 
     def test_convert_usd_to_gbp(self):
@@ -92,6 +303,75 @@ class CurrencyConverterTests(unittest.TestCase):
         self.assertEqual(data["ccy"], "GBP")
         self.assertEqual(data["quantity"], 123.45)
 
+    def test_convert_decimal_fallback_matches_scaled(self):
+        for ccy_from, ccy_to in [("EUR", "GBP"), ("GBP", "EUR"), ("USD", "EUR"), ("EUR", "EUR")]:
+            params = {"ccy_from": ccy_from, "ccy_to": ccy_to, "quantity": "1234.565"}
+            scaled = self.client.get("/convert", params=params).json()
+            exact = self.client.get("/convert", params={**params, "high_precision": "true"}).json()
+            self.assertEqual(scaled, exact)
+
+    def test_convert_high_precision_uses_sent_digits(self):
+        # As a float this quantity is 2.675 and would round up to 2.68.
+        params = {"ccy_from": "GBP", "ccy_to": "GBP", "quantity": "2.6749999999999999999", "high_precision": "true"}
+        r = self.client.get("/convert", params=params)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["quantity"], 2.67)
+
+    def test_convert_large_amount_high_precision(self):
+        params = {"ccy_from": "USD", "ccy_to": "EUR", "quantity": "100000000000000000000"}
+        for extra in ({}, {"high_precision": "true"}):
+            r = self.client.get("/convert", params={**params, **extra})
+            self.assertEqual(r.status_code, 200, extra)
+            self.assertEqual(r.json()["quantity"], 9e19)
+
+    def test_convert_more_than_six_decimals_rounds_once(self):
+        cases = [
+            (SNAPSHOT, "GBP", "GBP", "2.6749996", 2.67),
+            (SNAPSHOT, "GBP", "GBP", "0.0049999", 0.0),
+            (REALISTIC_SNAPSHOT, "USD", "EUR", "627.0688335", 578.13),
+            (REALISTIC_SNAPSHOT, "USD", "EUR", "416.8328991", 384.31),
+        ]
+        for snapshot, ccy_from, ccy_to, quantity, expected in cases:
+            async def _fake_get_rates_cached(snapshot=snapshot):
+                return snapshot
+
+            params = {"ccy_from": ccy_from, "ccy_to": ccy_to, "quantity": quantity}
+            with patch("app._get_rates_cached", new=_fake_get_rates_cached):
+                r = self.client.get("/convert", params=params)
+            self.assertEqual(r.status_code, 200, quantity)
+            self.assertEqual(r.json()["quantity"], expected, quantity)
+
+    def test_convert_quantity_upper_bound(self):
+        params = {"ccy_from": "GBP", "ccy_to": "USD", "quantity": str(app.MAX_QUANTITY)}
+        for extra in ({}, {"high_precision": "true"}):
+            r = self.client.get("/convert", params={**params, **extra})
+            self.assertEqual(r.status_code, 200, extra)
+            self.assertEqual(r.json()["quantity"], 1.25e24)
+            for quantity in ["1e26", "2e302", "1e303"]:
+                r = self.client.get("/convert", params={**params, **extra, "quantity": quantity})
+                self.assertEqual(r.status_code, 422, (quantity, extra))
+
+    def test_exact_path_matches_decimal_at_realistic_prices(self):
+        snapshot = REALISTIC_SNAPSHOT
+        rng = random.Random(0)
+        quantities = [7448113.19] + [rng.randrange(1, 10 ** 9) / 100 for _ in range(20000)]
+        for pair in snapshot.rate_table:
+            for quantity in quantities:
+                micros = round(quantity * app.QUANTITY_SCALE)
+                exact = app._convert_exact(micros, snapshot.rate_table_exact[pair])
+                decimal = float(app.round_number(Decimal(str(quantity)) * snapshot.rate_table[pair]))
+                self.assertEqual(exact, decimal, (pair, quantity))
+        self.assertEqual(app._convert_exact(7448113190000, snapshot.rate_table_exact[("USD", "EUR")]), 6866893.54)
+
+    def test_convert_rejects_non_positive_or_infinite_quantity(self):
+        for quantity in ["0", "-1", "inf", "nan"]:
+            r = self.client.get("/convert", params={"ccy_from": "USD", "ccy_to": "EUR", "quantity": quantity})
+            self.assertEqual(r.status_code, 422, quantity)
+
+    def test_convert_rejects_unknown_currency(self):
+        r = self.client.get("/convert", params={"ccy_from": "USD", "ccy_to": "JPY", "quantity": "100"})
+        self.assertEqual(r.status_code, 422)
+
     # ----- Optional: /rates shape -----
 
     def test_rates_endpoint_shape(self):
@@ -104,6 +384,8 @@ class CurrencyConverterTests(unittest.TestCase):
         self.assertIn("BTCUSDT", data["binance_prices"])
         self.assertIn("EURUSD", data["derived_cross_rates"])
         self.assertIn("USDGBP", data["derived_cross_rates"])
+        self.assertEqual(data["binance_prices"]["BTCEUR"], 90000.0)
+        self.assertEqual(data["derived_cross_rates"]["USDEUR"], 0.9)
 
 
 if __name__ == "__main__":